@@ -1,3 +1,8 @@
+# Patch the stdlib before anything else imports socket/threading so that
+# requests, icmplib and the DB locks cooperate with the eventlet hub.
+import eventlet
+eventlet.monkey_patch()
+
 from flask import Flask, render_template
 from flask_socketio import SocketIO
 import threading
@@ -7,11 +12,15 @@ from database import DatabaseService
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
 
 # Global services
-db_service = DatabaseService(app=app)
-geo_service = GeoIPService()
+# sqlite3 calls block the eventlet hub, so a lock held by another process
+# (e.g. a DB browser) would freeze all Socket.IO I/O for the whole busy
+# timeout. Fail fast instead; the background loops log the error and
+# retry on their next cycle.
+db_service = DatabaseService(app=app, busy_timeout=1000)
+geo_service = GeoIPService(db_service)
 traceroute_engine = TracerouteEngine(socketio, geo_service, app, db_service)
 monitor = ConnectionMonitor(socketio, traceroute_engine, app, db_service)
 
@@ -41,6 +50,7 @@ def handle_clear_history(data):
     # Notify all clients to clear their UI
     socketio.emit('history_cleared')
     # Trigger a rescan to populate currently active connections
+    monitor.reset_persisted()
     monitor.trigger_scan()
 
 if __name__ == '__main__':
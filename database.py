@@ -1,64 +1,131 @@
+import json
 import sqlite3
 import time
 import threading
+from contextlib import contextmanager
 
 class DatabaseService:
     """
     Handles SQLite database interactions for connections and latency history.
     """
     
-    def __init__(self, db_path="nettrace.db", app=None):
+    # Static hot-path statements; sqlite3's per-connection statement cache
+    # reuses their compiled form across calls on the long-lived connections.
+    _UPSERT_CONNECTION_SQL = '''
+        INSERT INTO connections (ip, first_seen, last_seen, protocol, city, isp, org, country, lat, lon, port)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(ip) DO UPDATE SET
+            last_seen = excluded.last_seen,
+            protocol = COALESCE(excluded.protocol, protocol),
+            port = COALESCE(excluded.port, port),
+            city = COALESCE(excluded.city, city),
+            isp = COALESCE(excluded.isp, isp),
+            org = COALESCE(excluded.org, org),
+            country = COALESCE(excluded.country, country),
+            lat = COALESCE(excluded.lat, lat),
+            lon = COALESCE(excluded.lon, lon)
+    '''
+    _INSERT_LATENCY_SQL = "INSERT INTO latency_history (ip, timestamp, rtt) VALUES (?, ?, ?)"
+
+    def __init__(self, db_path="nettrace.db", app=None, busy_timeout=30000):
         self.db_path = db_path
         self.app = app
-        self._lock = threading.Lock()
+        self.busy_timeout = busy_timeout # ms to wait on locks held by other processes
+        self._lock = threading.Lock() # serializes all use of the shared connection
+        self._conn = None
         self.init_db()
 
     def get_connection(self):
-        """Creates a new database connection."""
-        return sqlite3.connect(self.db_path)
+        """
+        Returns the shared database connection, opening it on first use.
+        
+        One connection is kept for the lifetime of the service so the page
+        cache and PRAGMA setup survive between calls. Under eventlet every
+        green task runs on the same OS thread, so per-thread connections
+        would buy nothing. Callers must hold self._lock. The connection runs
+        in autocommit mode; writes use explicit transactions via _transaction().
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._apply_pragmas(conn)
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        """Yields a cursor inside a BEGIN IMMEDIATE transaction, rolling back on error."""
+        conn = self.get_connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn.cursor()
+
+    def _apply_pragmas(self, conn):
+        """Applies per-connection tuning (busy timeout, sync level, cache)."""
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-20000")
+        # Cap the WAL file size left behind after checkpoints (64 MiB)
+        cursor.execute("PRAGMA journal_size_limit=67108864")
 
     def init_db(self):
         """Initializes the database schema if tables do not exist."""
         with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Connections table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS connections (
-                    ip TEXT PRIMARY KEY,
-                    first_seen REAL,
-                    last_seen REAL,
-                    protocol TEXT,
-                    city TEXT,
-                    isp TEXT,
-                    org TEXT,
-                    country TEXT,
-                    lat REAL,
-                    lon REAL,
-                    port INTEGER
-                )
-            ''')
-            
-            # Check if 'country' column exists (migration)
-            cursor.execute("PRAGMA table_info(connections)")
-            columns = [info[1] for info in cursor.fetchall()]
-            if 'country' not in columns:
-                cursor.execute("ALTER TABLE connections ADD COLUMN country TEXT")
-
-            # Latency history table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS latency_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ip TEXT,
-                    timestamp REAL,
-                    rtt REAL,
-                    FOREIGN KEY(ip) REFERENCES connections(ip)
-                )
-            ''')
-            
-            conn.commit()
-            conn.close()
+            # WAL keeps external readers (e.g. a DB browser) from blocking our writes.
+            # journal_mode is persistent on disk; not applicable to in-memory DBs.
+            # It cannot be changed inside a transaction.
+            if self.db_path != ':memory:':
+                self.get_connection().execute("PRAGMA journal_mode=WAL")
+
+            with self._transaction() as cursor:
+                # Connections table
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS connections (
+                        ip TEXT PRIMARY KEY,
+                        first_seen REAL,
+                        last_seen REAL,
+                        protocol TEXT,
+                        city TEXT,
+                        isp TEXT,
+                        org TEXT,
+                        country TEXT,
+                        lat REAL,
+                        lon REAL,
+                        port INTEGER
+                    )
+                ''')
+
+                # Check if 'country' column exists (migration)
+                cursor.execute("PRAGMA table_info(connections)")
+                columns = [info[1] for info in cursor.fetchall()]
+                if 'country' not in columns:
+                    cursor.execute("ALTER TABLE connections ADD COLUMN country TEXT")
+
+                # Latency history table
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS latency_history (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        ip TEXT,
+                        timestamp REAL,
+                        rtt REAL,
+                        FOREIGN KEY(ip) REFERENCES connections(ip)
+                    )
+                ''')
+
+                # GeoIP lookup cache (survives restarts, saves API quota)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS geo_cache (
+                        ip TEXT PRIMARY KEY,
+                        fetched_at REAL,
+                        payload TEXT
+                    )
+                ''')
+
+                # Indexes for per-IP history lookups and last_seen filtering
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_latency_ip_ts ON latency_history(ip, timestamp DESC)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_conn_last_seen ON connections(last_seen)")
 
     def update_connection(self, ip, port=None, protocol=None, geo_data=None):
         """
@@ -70,78 +137,39 @@ class DatabaseService:
             protocol (str): Protocol name.
             geo_data (dict): Geolocation information.
         """
-        with self._lock, self.app.app_context():
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            now = time.time()
-            
-            # Check if exists
-            cursor.execute("SELECT first_seen FROM connections WHERE ip = ?", (ip,))
-            row = cursor.fetchone()
-            
-            if row:
-                # Update last_seen and other fields if provided
-                update_fields = ["last_seen = ?"]
-                params = [now]
-                
-                if protocol:
-                    update_fields.append("protocol = ?")
-                    params.append(protocol)
-                if port:
-                    update_fields.append("port = ?")
-                    params.append(port)
-                if geo_data:
-                    update_fields.append("city = ?")
-                    params.append(geo_data.get('city'))
-                    update_fields.append("isp = ?")
-                    params.append(geo_data.get('isp'))
-                    update_fields.append("org = ?")
-                    params.append(geo_data.get('org'))
-                    update_fields.append("country = ?")
-                    params.append(geo_data.get('country'))
-                    update_fields.append("lat = ?")
-                    params.append(geo_data.get('lat'))
-                    update_fields.append("lon = ?")
-                    params.append(geo_data.get('lon'))
-                
-                params.append(ip)
-                cursor.execute(f"UPDATE connections SET {', '.join(update_fields)} WHERE ip = ?", params)
-            else:
-                # Insert new
-                city = geo_data.get('city') if geo_data else None
-                isp = geo_data.get('isp') if geo_data else None
-                org = geo_data.get('org') if geo_data else None
-                country = geo_data.get('country') if geo_data else None
-                lat = geo_data.get('lat') if geo_data else None
-                lon = geo_data.get('lon') if geo_data else None
-                
-                cursor.execute('''
-                    INSERT INTO connections (ip, first_seen, last_seen, protocol, city, isp, org, country, lat, lon, port)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (ip, now, now, protocol, city, isp, org, country, lat, lon, port))
-            
-            conn.commit()
-            conn.close()
+        geo = geo_data or {}
+        now = time.time()
+
+        with self._lock, self._transaction() as cursor:
+            # Single UPSERT; COALESCE keeps existing values when the caller passes None
+            cursor.execute(self._UPSERT_CONNECTION_SQL, (
+                ip, now, now, protocol, geo.get('city'), geo.get('isp'), geo.get('org'),
+                geo.get('country'), geo.get('lat'), geo.get('lon'), port
+            ))
 
     def add_latency_sample(self, ip, rtt):
         """Adds a new latency (RTT) sample for a connection."""
-        with self._lock, self.app.app_context():
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO latency_history (ip, timestamp, rtt) VALUES (?, ?, ?)", (ip, time.time(), rtt))
-            conn.commit()
-            conn.close()
+        with self._lock, self._transaction() as cursor:
+            cursor.execute(self._INSERT_LATENCY_SQL, (ip, time.time(), rtt))
+
+    def add_latency_samples(self, rows):
+        """
+        Adds many latency samples in a single transaction.
+        
+        Args:
+            rows (list): List of (ip, timestamp, rtt) tuples.
+        """
+        if not rows:
+            return
+        with self._lock, self._transaction() as cursor:
+            cursor.executemany(self._INSERT_LATENCY_SQL, rows)
 
     def get_all_connections(self):
         """Returns all connections from the database."""
-        # Read-only, no lock strictly needed but good practice if mixed with writes
-        conn = self.get_connection()
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM connections ORDER BY last_seen DESC")
-        rows = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            cursor = self.get_connection().cursor()
+            cursor.execute("SELECT * FROM connections ORDER BY last_seen DESC")
+            rows = cursor.fetchall()
         
         results = []
         for row in rows:
@@ -155,16 +183,51 @@ class DatabaseService:
         Returns:
             list: List of dicts [{'rtt': float, 'timestamp': float}]
         """
-        conn = self.get_connection()
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT rtt, timestamp FROM latency_history WHERE ip = ? ORDER BY timestamp DESC LIMIT ?", (ip, limit))
-        rows = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            cursor = self.get_connection().cursor()
+            cursor.execute("SELECT rtt, timestamp FROM latency_history WHERE ip = ? ORDER BY timestamp DESC LIMIT ?", (ip, limit))
+            rows = cursor.fetchall()
         
         # Return reversed (oldest to newest) for graphing
         return [{"rtt": row['rtt'], "timestamp": row['timestamp']} for row in rows][::-1]
 
+    def get_geo_cache(self, ip, max_age):
+        """
+        Returns a cached geolocation payload if it is younger than max_age.
+        
+        Args:
+            ip (str): IP address.
+            max_age (int): Maximum entry age in seconds.
+            
+        Returns:
+            dict: Cached geolocation data, or None on a miss.
+        """
+        with self._lock:
+            cursor = self.get_connection().cursor()
+            cursor.execute("SELECT payload, fetched_at FROM geo_cache WHERE ip = ?", (ip,))
+            row = cursor.fetchone()
+        if row and time.time() - row['fetched_at'] < max_age:
+            return json.loads(row['payload'])
+        return None
+
+    def set_geo_cache(self, ip, payload):
+        """Stores a geolocation payload for an IP."""
+        with self._lock, self._transaction() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO geo_cache (ip, fetched_at, payload) VALUES (?, ?, ?)",
+                           (ip, time.time(), json.dumps(payload)))
+
+    def prune_geo_cache(self, max_age):
+        """Deletes geolocation cache entries older than max_age seconds."""
+        with self._lock, self._transaction() as cursor:
+            cursor.execute("DELETE FROM geo_cache WHERE fetched_at < ?", (time.time() - max_age,))
+
+    def checkpoint(self):
+        """Checkpoints the WAL into the main database and truncates the WAL file."""
+        if self.db_path == ':memory:':
+            return
+        with self._lock:
+            self.get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
     def clear_history(self, older_than_seconds=None):
         """
         Clears history data.
@@ -172,10 +235,7 @@ class DatabaseService:
         Args:
             older_than_seconds (int, optional): If set, only clears data older than this age.
         """
-        with self._lock, self.app.app_context():
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
+        with self._lock, self._transaction() as cursor:
             if older_than_seconds:
                 cutoff = time.time() - older_than_seconds
                 # Delete latency history for old connections
@@ -186,6 +246,3 @@ class DatabaseService:
                 # Clear all
                 cursor.execute("DELETE FROM latency_history")
                 cursor.execute("DELETE FROM connections")
-            
-            conn.commit()
-            conn.close()
@@ -1,18 +1,76 @@
+import ipaddress
 import psutil
+import queue
 import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
 from icmplib import traceroute as icmp_traceroute, multiping
-from collections import deque
+from collections import deque, OrderedDict
+from functools import lru_cache
+
+@lru_cache(maxsize=4096)
+def is_public_ip(ip):
+    """
+    Checks whether an IP is globally routable (and therefore worth locating).
+    
+    Rejects RFC1918, loopback, link-local, CGNAT, multicast, IPv6 ULA and
+    anything that fails to parse.
+    """
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return addr.is_global and not addr.is_multicast
 
 class GeoIPService:
     """Service to handle IP geolocation requests with rate limiting."""
     
-    def __init__(self):
-        self.cache = {}
+    def __init__(self, db=None):
+        self.db = db
+        self.cache = OrderedDict() # LRU: most recently used at the end
+        self.MAX_ENTRIES = 10_000
         self.request_timestamps = deque()
         self.RATE_LIMIT = 45 # requests per minute
         self.WINDOW = 60 # seconds
+        self.batch_timestamps = deque()
+        self.BATCH_RATE_LIMIT = 15 # batch requests per minute (separate quota)
+        self.BATCH_SIZE = 100 # max IPs per batch request
+        self.FIELDS = 'status,message,lat,lon,city,isp,org,as,query,countryCode'
+        # Pooled keep-alive session so lookups skip the TCP handshake
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self.CACHE_TTL = 7 * 24 * 3600 # seconds, for the on-disk cache
+
+    def _get_cached(self, ip):
+        """Looks up an IP in the memory cache, then the on-disk cache."""
+        if ip in self.cache:
+            self.cache.move_to_end(ip)
+            return self.cache[ip]
+        if self.db:
+            result = self.db.get_geo_cache(ip, self.CACHE_TTL)
+            if result:
+                self._remember(ip, result)
+                return result
+        return None
+
+    def _remember(self, ip, result):
+        """Adds an entry to the memory cache, evicting the least recently used."""
+        self.cache[ip] = result
+        self.cache.move_to_end(ip)
+        while len(self.cache) > self.MAX_ENTRIES:
+            self.cache.popitem(last=False)
+
+    def _store(self, ip, result):
+        """Saves a successful lookup to the memory and on-disk caches."""
+        self._remember(ip, result)
+        if self.db:
+            self.db.set_geo_cache(ip, result)
+
+    def prune_cache(self):
+        """Evicts on-disk cache entries older than CACHE_TTL."""
+        if self.db:
+            self.db.prune_geo_cache(self.CACHE_TTL)
 
     def _can_make_request(self):
         """Checks if a new request is allowed under the rate limit."""
@@ -22,6 +80,30 @@ class GeoIPService:
         
         return len(self.request_timestamps) < self.RATE_LIMIT
 
+    def _can_make_batch_request(self):
+        """Checks if a new batch request is allowed under the batch rate limit."""
+        now = time.time()
+        while self.batch_timestamps and self.batch_timestamps[0] < now - self.WINDOW:
+            self.batch_timestamps.popleft()
+        
+        return len(self.batch_timestamps) < self.BATCH_RATE_LIMIT
+
+    def _parse_response(self, ip, data):
+        """Converts an ip-api.com response into a location dict and caches it."""
+        if data.get('status') != 'success':
+            return None
+        result = {
+            'lat': data['lat'], 
+            'lon': data['lon'], 
+            'isp': data['isp'], 
+            'city': data['city'],
+            'org': data.get('org', ''),
+            'asn': data.get('as', ''),
+            'country': data.get('countryCode', '')
+        }
+        self._store(ip, result)
+        return result
+
     def get_location(self, ip):
         """
         Fetches geolocation data for an IP address.
@@ -32,12 +114,13 @@ class GeoIPService:
         Returns:
             dict: Location data (lat, lon, etc.) or error info.
         """
-        # Quick filter for private ranges
-        if ip.startswith('192.168.') or ip.startswith('10.') or ip.startswith('127.'):
+        # Skip private, loopback and other non-routable ranges
+        if not is_public_ip(ip):
             return None
             
-        if ip in self.cache:
-            return self.cache[ip]
+        cached = self._get_cached(ip)
+        if cached:
+            return cached
 
         if not self._can_make_request():
             return {"error": "rate_limited"}
@@ -45,40 +128,79 @@ class GeoIPService:
         try:
             self.request_timestamps.append(time.time())
             # Request 'org', 'as', and 'countryCode'
-            response = requests.get(f'http://ip-api.com/json/{ip}?fields=status,message,lat,lon,city,isp,org,as,query,countryCode', timeout=5)
+            response = self.session.get(f'http://ip-api.com/json/{ip}?fields={self.FIELDS}', timeout=5)
             if response.status_code == 200:
-                data = response.json()
-                if data['status'] == 'success':
-                    result = {
-                        'lat': data['lat'], 
-                        'lon': data['lon'], 
-                        'isp': data['isp'], 
-                        'city': data['city'],
-                        'org': data.get('org', ''),
-                        'asn': data.get('as', ''),
-                        'country': data.get('countryCode', '')
-                    }
-                    self.cache[ip] = result
-                    return result
+                return self._parse_response(ip, response.json())
         except Exception as e:
             print(f"GeoIP error for {ip}: {e}")
         return None
+
+    def get_locations(self, ips):
+        """
+        Fetches geolocation data for many IPs using ip-api.com's batch endpoint.
+        
+        Cached and non-routable IPs are resolved locally; the rest are sent in
+        batches of up to BATCH_SIZE. If the batch quota is exhausted, falls back
+        to single lookups.
+        
+        Args:
+            ips (iterable): IP addresses to locate.
+            
+        Returns:
+            dict: Maps each IP to location data, error info, or None.
+        """
+        results = {}
+        pending = []
+        # Each distinct IP is resolved once, however many times it is passed in
+        for ip in dict.fromkeys(ips):
+            if not is_public_ip(ip):
+                results[ip] = None
+                continue
+            cached = self._get_cached(ip)
+            if cached:
+                results[ip] = cached
+            else:
+                pending.append(ip)
+
+        for i in range(0, len(pending), self.BATCH_SIZE):
+            chunk = pending[i:i + self.BATCH_SIZE]
+            if not self._can_make_batch_request():
+                for ip in chunk:
+                    results[ip] = self.get_location(ip)
+                continue
+
+            try:
+                self.batch_timestamps.append(time.time())
+                response = self.session.post('http://ip-api.com/batch',
+                                             json=[{'query': ip, 'fields': self.FIELDS} for ip in chunk],
+                                             timeout=5)
+                if response.status_code == 200:
+                    # Responses come back in request order
+                    for ip, data in zip(chunk, response.json()):
+                        results[ip] = self._parse_response(ip, data)
+            except Exception as e:
+                print(f"GeoIP batch error for {len(chunk)} IPs: {e}")
+        return results
     
     def get_rate_limit_status(self):
-         """Returns current rate limit status (requests remaining)."""
+         """Returns current rate limit status (single and batch requests remaining)."""
          now = time.time()
          while self.request_timestamps and self.request_timestamps[0] < now - self.WINDOW:
             self.request_timestamps.popleft()
+         while self.batch_timestamps and self.batch_timestamps[0] < now - self.WINDOW:
+            self.batch_timestamps.popleft()
          return {
              "remaining": self.RATE_LIMIT - len(self.request_timestamps),
-             "reset_in": int(self.WINDOW - (now - self.request_timestamps[0])) if self.request_timestamps else 0
+             "reset_in": int(self.WINDOW - (now - self.request_timestamps[0])) if self.request_timestamps else 0,
+             "batch_remaining": self.BATCH_RATE_LIMIT - len(self.batch_timestamps),
+             "batch_reset_in": int(self.WINDOW - (now - self.batch_timestamps[0])) if self.batch_timestamps else 0
          }
 
     def get_own_location(self):
         """Fetches the public IP and location of the host machine."""
         try:
             # First get public IP
-            ip = requests.get('https://api.ipify.org', timeout=3).text
+            ip = self.session.get('https://api.ipify.org', timeout=3).text
             return self.get_location(ip)
         except Exception as e:
             print(f"Failed to get own location: {e}")
@@ -92,18 +214,24 @@ class TracerouteEngine:
         self.geo_service = geo_service
         self.app = app
         self.db = db
-        self.queue = deque()
+        self.queue = queue.Queue()
         self.processed_ips = set()
+        self._queued = set() # mirrors queue contents for O(1) membership tests
+        self._lock = threading.Lock() # guards processed_ips and _queued
+        self.WORKERS = 4 # concurrent traceroutes
         self.running = False
         self.my_location = None
 
     def add_target(self, ip):
         """Adds a new IP to the traceroute queue."""
-        if ip not in self.processed_ips and ip not in self.queue:
-            self.queue.append(ip)
+        with self._lock:
+            if ip in self.processed_ips or ip in self._queued:
+                return
+            self._queued.add(ip)
+            self.queue.put(ip)
 
     def start(self):
-        """Starts the background traceroute worker."""
+        """Starts WORKERS background traceroute workers sharing the queue."""
         # Try to get own location once on start
         try:
              self.my_location = self.geo_service.get_own_location()
@@ -112,18 +240,22 @@ class TracerouteEngine:
              pass
 
         self.running = True
-        self.socketio.start_background_task(self._run)
+        # Traceroute is network-bound, so run several workers on the same queue
+        for _ in range(self.WORKERS):
+            self.socketio.start_background_task(self._run)
 
     def _run(self):
-        """Main worker loop processing the queue."""
-        with self.app.app_context():
-            while self.running:
-                if self.queue:
-                    ip = self.queue.popleft()
-                    self.perform_traceroute(ip)
-                    self.processed_ips.add(ip)
-                else:
-                    self.socketio.sleep(1)
+        """Worker loop processing the queue."""
+        while self.running:
+            try:
+                ip = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            # Mark before tracing so add_target ignores in-flight IPs
+            with self._lock:
+                self._queued.discard(ip)
+                self.processed_ips.add(ip)
+            self.perform_traceroute(ip)
 
     def perform_traceroute(self, target_ip):
         """
@@ -140,6 +272,11 @@ class TracerouteEngine:
             print(f"Traceroute to {target_ip}: Found {len(hops)} hops")
             path_data = []
             
+            # Locate the distinct hops plus the target (often the last hop) in one batch request
+            unique_ips = {hop.address for hop in hops}
+            unique_ips.add(target_ip)
+            geo_map = self.geo_service.get_locations(unique_ips)
+            
             # Re-construct path including hops
             for hop in hops:
                 hop_info = {
@@ -147,13 +284,13 @@ class TracerouteEngine:
                     'address': hop.address,
                     'avg_rtt': hop.avg_rtt,
                 }
-                geo = self.geo_service.get_location(hop.address)
+                geo = geo_map.get(hop.address)
                 if geo and 'error' not in geo:
                     hop_info.update(geo)
                 
                 path_data.append(hop_info)
             
-            final_geo = self.geo_service.get_location(target_ip)
+            final_geo = geo_map.get(target_ip)
             
             # ... (DB updates omitted for brevity, logic remains same)
             # Persist Latency Sample
@@ -188,12 +325,16 @@ class ConnectionMonitor:
         self.db = db
         self.running = False
         self.seen_connections = set()
+        self._last_persisted = {} # ip -> time last_seen was written to the DB
+        self.PERSIST_INTERVAL = 30 # seconds between last_seen writes per IP
 
     def start(self):
         """Starts the monitoring background tasks."""
         self.running = True
         self.socketio.start_background_task(self._monitor_loop)
         self.socketio.start_background_task(self._rate_limit_emitter)
+        self.socketio.start_background_task(self._geo_cache_sweeper)
+        self.socketio.start_background_task(self._wal_checkpointer)
 
     def _monitor_loop(self):
         """
@@ -202,29 +343,25 @@ class ConnectionMonitor:
         2. Periodically scans for new connections.
         3. Measures latency for active connections.
         """
-        with self.app.app_context():
-            # Load existing connections from DB on start
-            history = self.db.get_all_connections()
-            for row in history:
-                ip = row['ip']
-                self.seen_connections.add(ip)
-                # Emit to frontend so it populates sidebar immediately
-                self.socketio.emit('new_connection', {
-                    'ip': ip, 
-                    'history': True,
-                    'first_seen': row['first_seen'],
-                    'geo': {
-                        'city': row['city'], 'isp': row['isp'], 'org': row['org'], 
-                        'lat': row['lat'], 'lon': row['lon'], 'country': row.get('country') # Assuming we might add country later or get it now
-                    } if row['lat'] else None
-                })
-                # Re-queue for traceroute to get fresh RTT? Maybe optional.
-                # For now, let's just show history.
-
-            while self.running:
-                self.scan()
-                self.measure_latencies()
-                self.socketio.sleep(2) # Faster updates
+        # Load existing connections from DB on start
+        history = self.db.get_all_connections()
+        self.seen_connections.update(row['ip'] for row in history)
+        # Emit the whole history as one frame so the sidebar populates immediately
+        self.socketio.emit('connections_snapshot', [{
+            'ip': row['ip'],
+            'history': True,
+            'first_seen': row['first_seen'],
+            'protocol': row['protocol'],
+            'geo': {
+                'city': row['city'], 'isp': row['isp'], 'org': row['org'], 
+                'lat': row['lat'], 'lon': row['lon'], 'country': row['country']
+            } if row['lat'] else None
+        } for row in history])
+
+        while self.running:
+            self.scan()
+            self.measure_latencies()
+            self.socketio.sleep(2) # Faster updates
 
     def measure_latencies(self):
         """Sends ICMP pings to all active targets to get live RTT."""
@@ -235,23 +372,44 @@ class ConnectionMonitor:
         # Use multiping for efficiency
         try:
             results = multiping(targets, count=1, interval=0.1, timeout=1)
-            for res in results:
-                if res.is_alive:
-                    self.db.add_latency_sample(res.address, res.avg_rtt)
-                    self.socketio.emit('latency_update', {
-                        'ip': res.address,
-                        'rtt': res.avg_rtt
-                    })
+            updates = [{'ip': res.address, 'rtt': res.avg_rtt} for res in results if res.is_alive]
+            if not updates:
+                return
+            # Push to the UI first so it is not held up by the DB commit
+            self.socketio.emit('latency_batch', updates)
+            now = time.time()
+            self.db.add_latency_samples([(u['ip'], now, u['rtt']) for u in updates])
         except Exception as e:
             print(f"Latency measure error: {e}")
 
     def _rate_limit_emitter(self):
         """Emits GeoIP rate limit status to frontend periodically."""
-        with self.app.app_context():
-            while self.running:
-                status = self.traceroute_engine.geo_service.get_rate_limit_status()
-                self.socketio.emit('rate_limit_status', status)
-                self.socketio.sleep(1)
+        while self.running:
+            status = self.traceroute_engine.geo_service.get_rate_limit_status()
+            self.socketio.emit('rate_limit_status', status)
+            self.socketio.sleep(1)
+
+    def _geo_cache_sweeper(self):
+        """Periodically evicts expired entries from the on-disk GeoIP cache."""
+        while self.running:
+            try:
+                self.traceroute_engine.geo_service.prune_cache()
+            except Exception as e:
+                print(f"GeoIP cache sweep error: {e}")
+            self.socketio.sleep(3600)
+
+    def _wal_checkpointer(self):
+        """Periodically checkpoints the SQLite WAL so it doesn't grow between auto-checkpoints."""
+        while self.running:
+            self.socketio.sleep(300)
+            try:
+                self.db.checkpoint()
+            except Exception as e:
+                print(f"WAL checkpoint error: {e}")
+
+    def reset_persisted(self):
+        """Forgets debounce state so the next scan rewrites every active connection."""
+        self._last_persisted.clear()
 
     def trigger_scan(self):
         """Manually triggers a connection scan."""
@@ -269,40 +427,42 @@ class ConnectionMonitor:
     def scan(self):
         """Scans system connections using psutil."""
         try:
-            connections = psutil.net_connections(kind='inet')
-            active_remote_ips = set()
+            # Only TCP sockets have an ESTABLISHED state, so skip reading UDP tables
+            connections = psutil.net_connections(kind='tcp')
             
-            # Map IP to details for this scan
+            # Map IP to (port, protocol) for this scan
             current_scan_details = {} 
 
             for conn in connections:
                 if conn.status == 'ESTABLISHED' and conn.raddr:
                     ip = conn.raddr.ip
                     port = conn.raddr.port
-                    if ip != '127.0.0.1' and ip != '::1': 
-                        active_remote_ips.add(ip)
-                        current_scan_details[ip] = {
-                            'port': port,
-                            'protocol': self._identify_protocol(port)
-                        }
+                    # LAN, loopback and other non-routable peers can't be located or traced usefully
+                    if is_public_ip(ip):
+                        current_scan_details[ip] = (port, self._identify_protocol(port))
             
-            if len(active_remote_ips) == 0 and '8.8.8.8' not in self.seen_connections:
-                 active_remote_ips.add('8.8.8.8')
-                 current_scan_details['8.8.8.8'] = {'port': 53, 'protocol': 'DNS'}
+            if not current_scan_details and '8.8.8.8' not in self.seen_connections:
+                 current_scan_details['8.8.8.8'] = (53, 'DNS')
 
-            for ip in active_remote_ips:
-                # Update DB every time seen (updates last_seen timestamp)
-                details = current_scan_details.get(ip, {})
-                self.db.update_connection(ip, port=details.get('port'), protocol=details.get('protocol'))
+            now = time.time()
+            for ip, (port, protocol) in current_scan_details.items():
+                # Only bump last_seen in the DB every PERSIST_INTERVAL seconds per IP
+                if now - self._last_persisted.get(ip, 0) >= self.PERSIST_INTERVAL:
+                    self.db.update_connection(ip, port=port, protocol=protocol)
+                    self._last_persisted[ip] = now
 
                 if ip not in self.seen_connections:
                     self.seen_connections.add(ip)
                     self.socketio.emit('new_connection', {
                         'ip': ip, 
-                        'protocol': details.get('protocol'),
+                        'protocol': protocol,
                         'first_seen': time.time()
                     })
                     self.traceroute_engine.add_target(ip)
 
+            # Forget closed connections so they are written as soon as they reappear
+            for ip in self._last_persisted.keys() - current_scan_details.keys():
+                self._last_persisted.pop(ip, None)
+
         except Exception as e:
             print(f"Scan error: {e}")
@@ -82,12 +82,26 @@ socket.on('connect', () => console.log('Connected to server'));
 socket.on('rate_limit_status', (data) => {
     var el = document.getElementById('rate-limit-text');
     if (el) {
-        el.innerText = `GeoIP Requests: ${data.remaining} left (Resets in ${data.reset_in}s)`;
-        el.style.color = data.remaining < 5 ? '#f85149' : '#8b949e';
+        el.innerText = `GeoIP Requests: ${data.remaining} left (Resets in ${data.reset_in}s) | ` +
+            `Batch: ${data.batch_remaining} left (Resets in ${data.batch_reset_in}s)`;
+        el.style.color = (data.remaining < 5 || data.batch_remaining < 2) ? '#f85149' : '#8b949e';
     }
 });
 
 socket.on('new_connection', (data) => {
+    if (addConnection(data)) {
+        updateStats();
+    }
+});
+
+socket.on('connections_snapshot', (snapshot) => {
+    // Add all history rows, then redraw the globe and stats once
+    snapshot.forEach(data => addConnection(data, true));
+    updateGlobeData();
+    updateStats();
+});
+
+function addConnection(data, deferGlobe) {
     var ip = data.ip;
     if (!connections[ip]) {
         connections[ip] = {
@@ -105,11 +119,12 @@ socket.on('new_connection', (data) => {
 
         // If history data came with it
         if (data.geo) {
-            updateViz(ip);
+            updateViz(ip, deferGlobe);
         }
-        updateStats();
+        return true;
     }
-});
+    return false;
+}
 
 socket.on('traceroute_result', (data) => {
     var target = data.target;
@@ -181,7 +196,11 @@ socket.on('history_cleared', () => {
     }
 });
 
-socket.on('latency_update', (data) => {
+socket.on('latency_batch', (batch) => {
+    batch.forEach(applyLatencyUpdate);
+});
+
+function applyLatencyUpdate(data) {
     var ip = data.ip;
     if (!connections[ip]) return;
 
@@ -210,11 +229,11 @@ socket.on('latency_update', (data) => {
         // Create if missing
         renderSparkline(ip, [{ rtt: data.rtt }]);
     }
-});
+}
 
 // --- Visualization Updates ---
 
-function updateViz(ip) {
+function updateViz(ip, deferGlobe) {
     var info = connections[ip].info;
     if (!info.geo || info.geo.error) return;
 
@@ -260,7 +279,7 @@ function updateViz(ip) {
     layerGroup.addTo(map);
 
     // 3D Globe Update
-    updateGlobeData();
+    if (!deferGlobe) updateGlobeData();
 }
 
 function updateGlobeData() {